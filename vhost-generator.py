@@ -1,11 +1,16 @@
 # Modules
 import boto3
-import pymysql
+import concurrent.futures
+import io
 import logging
 import os
-import re
 import shutil
+import string
+import struct
 import sys
+import tempfile
+import threading
+import time
 import zipfile
 
 # Vars from variables.py
@@ -20,16 +25,102 @@ from variables import rds_hostname
 from variables import rds_username
 from variables import rds_password
 from variables import rds_port
+from boto3.s3.transfer import TransferConfig
+from boto3.s3.transfer import create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+from botocore.exceptions import WaiterError
+from botocore.waiter import WaiterModel
+from botocore.waiter import create_waiter_with_client
 from datetime import datetime
 
-# AWS vars
-eb = boto3.client('elasticbeanstalk')
-s3 = boto3.resource('s3')
-r53 = boto3.client('route53')
+# AWS vars, clients are created on first use and kept in a warm container
+session = boto3.session.Session()
+client_config = Config(
+    max_pool_connections=50,
+    retries={
+        'mode': 'adaptive',
+        'max_attempts': 10
+    },
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=60
+)
+clients = {}
+client_lock = threading.RLock()
+
+# Multipart settings for the app bundle downloads/uploads
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=20,
+    max_io_queue=1000,
+    io_chunksize=256 * 1024,
+    use_threads=True
+)
+s3_transfer = None
+
+# Elastic Beanstalk has no built-in waiter for application versions
+waiter_model = WaiterModel({
+    'version': 2,
+    'waiters': {
+        'ApplicationVersionProcessed': {
+            'operation': 'DescribeApplicationVersions',
+            'delay': 5,
+            'maxAttempts': 60,
+            'acceptors': [
+                {
+                    'matcher': 'pathAll',
+                    'argument': 'ApplicationVersions[].Status',
+                    'expected': 'PROCESSED',
+                    'state': 'success'
+                },
+                {
+                    'matcher': 'pathAny',
+                    'argument': 'ApplicationVersions[].Status',
+                    'expected': 'FAILED',
+                    'state': 'failure'
+                }
+            ]
+        }
+    }
+})
 
 # Some vars
 dst_path = '/tmp'
-object_list = '{0}/object_list.txt'.format(dst_path)
+spool_size = 64 * 1024 * 1024
+
+# S3 wants every part of a multipart upload but the last to be 5 MB or more
+min_part_size = 5 * 1024 * 1024
+
+# Zip end of central directory record (APPNOTE 4.3.16) and the general
+# purpose flag marking UTF-8 entry names (APPNOTE 4.4.4, bit 11)
+end_record = struct.Struct('<4s4H2LH')
+end_record_signature = b'PK\x05\x06'
+utf8_flag = 0x800
+
+# VirtualHost config and env variables for a customer
+vhost_template = string.Template("""\
+<VirtualHost *:80>
+    ServerName ${customer}.${domain}
+    ServerAlias www.${customer}.${domain}
+    DocumentRoot /var/www/clients/${customer}
+
+    SetEnv RDS_HOSTNAME "${rds_hostname}"
+    SetEnv RDS_DB_NAME "${customer}"
+    SetEnv RDS_USERNAME "${rds_username}"
+    SetEnv RDS_PASSWORD "${rds_password}"
+    SetEnv RDS_PORT "${rds_port}"
+</VirtualHost>
+""")
+
+# RDS connection, kept across invocations in a warm container
+db = None
+
+# App version and bundle key per environment, kept for version_ttl seconds
+version_cache = {}
+version_ttl = 60
 
 # Logging
 formatter = logging.Formatter(
@@ -40,15 +131,43 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+def get_client(service_name):
+    """
+    Return the client for an AWS service, creating it on first use
+    """
+    with client_lock:
+        if service_name not in clients:
+            clients[service_name] = session.client(
+                service_name,
+                config=client_config
+            )
+
+        return clients[service_name]
+
+
+def get_transfer_manager():
+    """
+    Return the S3 transfer manager, creating it on first use
+    """
+    global s3_transfer
+
+    with client_lock:
+        if s3_transfer is None:
+            s3_transfer = create_transfer_manager(
+                get_client('s3'),
+                transfer_config
+            )
+
+        return s3_transfer
+
+
 def clean_up(extraction_path):
     """
     Perform clean up
     """
-    # noinspection PyBroadException
     try:
-        os.unlink(object_list)
         shutil.rmtree(extraction_path)
-    except:
+    except OSError:
         pass
 
 
@@ -56,6 +175,15 @@ def check_version():
     """
     Find the latest version of the object in the S3 bucket
     """
+    entry = version_cache.get(env_name)
+
+    if entry and time.monotonic() - entry[2] < version_ttl:
+        logger.info('Current app version (cached): {}'.format(entry[0]))
+        return entry[1]
+
+    eb = get_client('elasticbeanstalk')
+    s3 = get_client('s3')
+
     try:
         # Get the current version from Elastic Beanstalk
         logger.info('Getting app version')
@@ -74,51 +202,111 @@ def check_version():
         logger.info('Current app version: {}'.format(current_version))
 
         # Find the zip file that matches the current version
-        s3_bucket = s3.Bucket(bucket)
+        needle = '{0}.zip'.format(current_version)
+        paginator = s3.get_paginator('list_objects_v2')
 
         logger.info('Finding the app version in {}'.format(bucket))
 
-        # Save the list of objects to a text file
-        with open(object_list, 'a') as fh:
-            for obj in s3_bucket.objects.all():
-                fh.write('{0}\n'.format(obj.key))
+        # Bundles uploaded by this function sit at the bucket root, the ones
+        # deployed with the EB CLI under the application name
+        prefixes = [
+            current_version,
+            '{0}/{1}'.format(app_name, current_version)
+        ]
+
+        # Only list the keys that start with the current version
+        for prefix in prefixes:
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    if obj['Key'].endswith(needle):
+                        version_cache[env_name] = (
+                            current_version,
+                            obj['Key'],
+                            time.monotonic()
+                        )
+
+                        return obj['Key']
+    except ClientError as e:
+        logger.error(e)
+        raise
+
+    raise LookupError('No bundle for app version {0} in {1}'
+                      .format(current_version, bucket))
+
+
+def member_dir(extraction_path, info):
+    """
+    Return the directory a zip entry will be extracted into
+    """
+    name = info.filename if info.is_dir() else os.path.dirname(info.filename)
 
-        # Open the object_list.txt and check the last_modified date
-        with open(object_list, 'r') as fh:
-            for key in fh:
-                if re.search('{0}.zip'.format(current_version), key):
-                    stripped_key = key.strip()
+    # Drop the same path components that ZipFile.extract() ignores
+    parts = [x for x in name.split('/') if x not in ('', os.curdir, os.pardir)]
 
-                    return stripped_key
-    except Exception as e:
-        logger.error(e, exc_info=True)
-        sys.exit(1)
+    return os.path.join(extraction_path, *parts)
 
 
 def download_from_s3(key):
     """
     Get the object from the S3 bucket
     """
+    s3_transfer = get_transfer_manager()
+
     try:
         file_path = '{0}/{1}'.format(dst_path, key)
-        extraction_path = format(os.path.splitext(file_path)[0])
+        extraction_path = os.path.splitext(file_path)[0]
 
         logger.info('Downloading app version to {}'.format(extraction_path))
 
-        s3.meta.client.download_file(bucket, key, file_path)
+        # Drop anything a failed run left behind in a warm container, the
+        # extraction below creates the directory tree again
+        clean_up(extraction_path)
+
+        # An anonymous temp file, ZipFile can't read a SpooledTemporaryFile
+        # before Python 3.11 as it has no seekable()
+        with tempfile.TemporaryFile(dir=dst_path) as fh:
+            s3_transfer.download(bucket, key, fh).result()
+            fh.seek(0)
 
-        # Create an extraction directory
-        os.makedirs(extraction_path)
+            # Extract the file downloaded from S3
+            with zipfile.ZipFile(fh, 'r') as zip_ref:
+                members = zip_ref.infolist()
 
-        # Extract the file downloaded from S3
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(extraction_path)
+                # Create the directory tree first so the workers don't race
+                for info in members:
+                    os.makedirs(member_dir(extraction_path, info),
+                                exist_ok=True)
+
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=os.cpu_count()) as executor:
+                    futures = [
+                        executor.submit(zip_ref.extract, info,
+                                        extraction_path)
+                        for info in members if not info.is_dir()
+                    ]
+
+                    for future in futures:
+                        future.result()
 
         logger.info('App downloaded')
         return extraction_path
-    except Exception as e:
-        logger.error(e, exc_info=True)
-        sys.exit(1)
+    except (ClientError, OSError, zipfile.BadZipFile) as e:
+        logger.error(e)
+        raise
+
+
+def render_vhost(customer):
+    """
+    Render the VirtualHost config for the new customer
+    """
+    return vhost_template.substitute(
+        customer=customer,
+        domain=domain,
+        rds_hostname=rds_hostname,
+        rds_username=rds_username,
+        rds_password=rds_password,
+        rds_port=rds_port
+    ).encode()
 
 
 def create_vhost(customer, extraction_path):
@@ -131,65 +319,277 @@ def create_vhost(customer, extraction_path):
 
         logger.info('Creating VirtualHost config')
 
-        # Write the VirtualHost config and env variables to customer.conf
-        with open('{0}/{1}.conf'.format(vhosts_path, customer), 'w') as fh:
-            fh.write("""\
-<VirtualHost *:80>
-    ServerName {0}.{1}
-    ServerAlias www.{0}.{1}
-    DocumentRoot /var/www/clients/{0}
-
-    SetEnv RDS_HOSTNAME "{2}"
-    SetEnv RDS_DB_NAME "{0}"
-    SetEnv RDS_USERNAME "{3}"
-    SetEnv RDS_PASSWORD "{4}"
-    SetEnv RDS_PORT "{5}"
-</VirtualHost>
-""".format(
-                    customer,
-                    domain,
-                    rds_hostname,
-                    rds_username,
-                    rds_password,
-                    rds_port
-                )
+        data = render_vhost(customer)
+
+        conf_path = '{0}/{1}.conf'.format(vhosts_path, customer)
+        tmp_path = '{}.tmp'.format(conf_path)
+
+        # Write the VirtualHost config in one syscall, then swap it in
+        # so Apache never sees a partially written customer.conf
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.replace(tmp_path, conf_path)
+
+        logger.info('VirtualHost config created')
+    except OSError as e:
+        logger.error(e)
+        raise
+
+
+def archive_app(dir_name, fh):
+    """
+    Compress the app directory into a file object
+    """
+    # Beanstalk only takes zip bundles, so trade some size for speed
+    with zipfile.ZipFile(fh, 'w', zipfile.ZIP_DEFLATED,
+                         compresslevel=1) as zip_ref:
+        for root, dirs, files in os.walk(dir_name):
+            dirs.sort()
+
+            for name in dirs + sorted(files):
+                path = os.path.join(root, name)
+                zip_ref.write(path, os.path.relpath(path, dir_name))
+
+
+class BundleTail(io.BytesIO):
+    """
+    In-memory copy of the end of a zip in S3, addressed by object offsets
+    """
+    def __init__(self, data, offset):
+        super().__init__(data)
+        self.offset = offset
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos -= self.offset
+
+        return super().seek(pos, whence) + self.offset
+
+    def tell(self):
+        return super().tell() + self.offset
+
+
+def append_to_zip(tail, arcname, data):
+    """
+    Add a file to the zip whose central directory is held in tail
+    """
+    with zipfile.ZipFile(tail, 'a') as zip_ref:
+        count = len(zip_ref.infolist())
+
+        # The new entry has to take the place of the old central directory
+        if zip_ref.start_dir != tail.offset:
+            return False
+
+        info = zipfile.ZipInfo(arcname, datetime.now().timetuple()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        zip_ref.writestr(info, data)
+
+    with zipfile.ZipFile(tail, 'r') as zip_ref:
+        return len(zip_ref.infolist()) == count + 1
+
+
+def append_vhost(customer, src_key, new_app_version):
+    """
+    Copy the app bundle in S3 with the new VirtualHost config appended
+
+    The existing entries are copied inside S3 with UploadPartCopy and only
+    the new entry and the rewritten central directory are uploaded. Returns
+    False when the bundle has to be rebuilt locally instead.
+    """
+    s3 = get_client('s3')
+    dst_key = '{0}.zip'.format(new_app_version)
+    arcname = '.ebextensions/vhosts/{}.conf'.format(customer)
+
+    try:
+        # Read the end of central directory record, a zip comment or
+        # anything but a plain zip sends us down the local rebuild
+        response = s3.get_object(
+            Bucket=bucket,
+            Key=src_key,
+            Range='bytes=-{}'.format(end_record.size)
+        )
+        etag = response['ETag']
+        size = int(response['ContentRange'].split('/')[1])
+        endrec = response['Body'].read()
+
+        if (len(endrec) != end_record.size or
+                not endrec.startswith(end_record_signature)):
+            logger.info('Unsupported bundle, rebuilding it locally')
+            return False
+
+        (_, disk, cd_disk, _, _,
+         cd_size, cd_offset, comment_size) = end_record.unpack(endrec)
+
+        # Spanned, ZIP64 and prefixed zips don't line up with the record
+        if (disk or cd_disk or comment_size or
+                cd_offset + cd_size + end_record.size != size):
+            logger.info('Unsupported bundle, rebuilding it locally')
+            return False
+
+        if cd_offset < min_part_size:
+            logger.info('Small bundle, rebuilding it locally')
+            return False
+
+        response = s3.get_object(
+            Bucket=bucket,
+            Key=src_key,
+            Range='bytes={}-'.format(cd_offset),
+            IfMatch=etag
+        )
+        tail = BundleTail(response['Body'].read(), cd_offset)
+
+        try:
+            # ZipFile(tail, 'a') takes a central directory it can't read for
+            # an empty zip, so make sure it reads on its own first
+            with zipfile.ZipFile(tail, 'r') as zip_ref:
+                members = zip_ref.infolist()
+                start_dir = zip_ref.start_dir
+
+            if start_dir != cd_offset:
+                logger.info('Unsupported bundle, rebuilding it locally')
+                return False
+
+            # ZipFile writes cp437 names back as UTF-8, so they would no
+            # longer match the local headers we copy unchanged
+            if any(not info.flag_bits & utf8_flag and
+                   not info.filename.isascii() for info in members):
+                logger.info('Bundle has non UTF-8 entry names, rebuilding '
+                            'it locally')
+                return False
+
+            if arcname in [info.filename for info in members]:
+                logger.info('{} is already in the bundle, rebuilding it '
+                            'locally'.format(arcname))
+                return False
+
+            if not append_to_zip(tail, arcname, render_vhost(customer)):
+                logger.info('Unable to append {}, rebuilding it locally'
+                            .format(arcname))
+                return False
+        except zipfile.BadZipFile as e:
+            logger.info('Unsupported bundle ({}), rebuilding it locally'
+                        .format(e))
+            return False
+
+        logger.info('Appending {0} to {1}'.format(arcname, dst_key))
+
+        upload_id = s3.create_multipart_upload(
+            Bucket=bucket,
+            Key=dst_key
+        )['UploadId']
+        completed = False
+
+        try:
+            # Copy the existing entries, then add the new tail after them
+            copy_part = s3.upload_part_copy(
+                Bucket=bucket,
+                Key=dst_key,
+                UploadId=upload_id,
+                PartNumber=1,
+                CopySource={
+                    'Bucket': bucket,
+                    'Key': src_key
+                },
+                CopySourceIfMatch=etag,
+                CopySourceRange='bytes=0-{}'.format(cd_offset - 1)
+            )
+            tail_part = s3.upload_part(
+                Bucket=bucket,
+                Key=dst_key,
+                UploadId=upload_id,
+                PartNumber=2,
+                Body=tail.getvalue()
+            )
+
+            s3.complete_multipart_upload(
+                Bucket=bucket,
+                Key=dst_key,
+                UploadId=upload_id,
+                MultipartUpload={
+                    'Parts': [
+                        {
+                            'PartNumber': 1,
+                            'ETag': copy_part['CopyPartResult']['ETag']
+                        },
+                        {
+                            'PartNumber': 2,
+                            'ETag': tail_part['ETag']
+                        }
+                    ]
+                }
             )
+            completed = True
+        finally:
+            # Don't leave the parts behind, whatever the copy failed on
+            if not completed:
+                try:
+                    s3.abort_multipart_upload(
+                        Bucket=bucket,
+                        Key=dst_key,
+                        UploadId=upload_id
+                    )
+                except (ClientError, BotoCoreError) as e:
+                    logger.error('Unable to abort upload {0}: {1}'
+                                 .format(upload_id, e))
 
         logger.info('VirtualHost config created')
-    except Exception as e:
-        logger.error(e, exc_info=True)
-        sys.exit(1)
+        return True
+    except ClientError as e:
+        logger.error(e)
+        raise
 
 
-def deploy_app(dir_name):
+def upload_app(dir_name, new_app_version):
     """
-    Deploy application to Elastic Beanstalk
+    Compress the app directory and upload it to the S3 bucket
     """
-    now = datetime.now()
-    date = '{:04d}{:02d}{:02d}-{:02d}{:02d}{:02d}'.format(
-        now.year,
-        now.month,
-        now.day,
-        now.hour,
-        now.minute,
-        now.second
-    )
-    new_app_version = '{0}-{1}'.format(domain, date)
-    output_filename = '{0}/{1}'.format(dst_path, new_app_version)
+    s3_transfer = get_transfer_manager()
 
     try:
-        # Compress the app directory
-        shutil.make_archive(output_filename, 'zip', dir_name)
+        # Compress the app directory and upload it to S3
+        with tempfile.SpooledTemporaryFile(max_size=spool_size,
+                                           dir=dst_path) as fh:
+            archive_app(dir_name, fh)
+            fh.seek(0)
+
+            s3_transfer.upload(
+                fh,
+                bucket,
+                '{0}.zip'.format(new_app_version)
+            ).result()
+
+        clean_up(dir_name)
+    except (ClientError, OSError) as e:
+        logger.error(e)
+        raise
+
+
+def get_version_label():
+    """
+    Return a new, timestamped app version label
+    """
+    date = datetime.now().strftime('%Y%m%d-%H%M%S')
+
+    return '{0}-{1}'.format(domain, date)
 
+
+def deploy_app(new_app_version):
+    """
+    Deploy application to Elastic Beanstalk
+    """
+    eb = get_client('elasticbeanstalk')
+
+    try:
         logger.info('Deploying {} to Elastic Beanstalk'
                     .format(new_app_version))
 
-        # Upload the compressed file to S3
-        s3.Bucket(bucket).upload_file('{0}.zip'.format(
-            output_filename),
-            '{0}.zip'.format(new_app_version)
-        )
-
         # Create a new application version
         eb.create_application_version(
             ApplicationName=app_name,
@@ -202,19 +602,18 @@ def deploy_app(dir_name):
             Process=True
         )
 
-        # Check the application status
-        while True:
-            response = eb.describe_application_versions(
-                ApplicationName=app_name,
-                VersionLabels=[
-                    new_app_version
-                ]
-            )
-            status = 'PROCESSED'
-            app_status = response['ApplicationVersions'][0]['Status']
-
-            if status == app_status:
-                break
+        # Wait until the application version has been processed
+        waiter = create_waiter_with_client(
+            'ApplicationVersionProcessed',
+            waiter_model,
+            eb
+        )
+        waiter.wait(
+            ApplicationName=app_name,
+            VersionLabels=[
+                new_app_version
+            ]
+        )
 
         # Deploy the app to Elastic Beanstalk
         eb.update_environment(
@@ -223,49 +622,89 @@ def deploy_app(dir_name):
             VersionLabel=new_app_version
         )
 
+        # The next customer has to be added on top of this version
+        version_cache[env_name] = (
+            new_app_version,
+            '{0}.zip'.format(new_app_version),
+            time.monotonic()
+        )
+
         logger.info('New app version ({}) is now deployed to EB'.format(new_app_version))
-        clean_up(dir_name)
         return new_app_version
-    except Exception as e:
-        logger.error(e, exc_info=True)
-        sys.exit(1)
+    except WaiterError as e:
+        logger.error('App version ({0}) was not processed: {1}'
+                     .format(new_app_version, e))
+        raise
+    except ClientError as e:
+        logger.error(e)
+        raise
+
+
+def get_db():
+    """
+    Return the RDS connection, reconnecting if it has gone away
+    """
+    global db
+
+    if db is None:
+        # Only pay for the import when a database is actually created
+        import pymysql
+        from pymysql.constants import CLIENT
+
+        db = pymysql.connect(
+            host=rds_hostname,
+            user=rds_username,
+            password=rds_password,
+            client_flag=CLIENT.MULTI_STATEMENTS
+        )
+    else:
+        db.ping(reconnect=True)
+
+    return db
 
 
 def create_db(customer):
     """
     Create a new database in RDS
     """
-    db_name = customer
-    db = pymysql.connect(
-        rds_hostname,
-        rds_username,
-        rds_password
-    )
-    cursor = db.cursor()
+    import pymysql
+
+    db_name = customer.replace('`', '``')
+    conn = get_db()
+    cursor = conn.cursor()
 
     try:
-        logger.info('Creating {0} in {1}...'.format(db_name, rds_hostname))
-        cursor.execute('CREATE DATABASE {}'.format(db_name))
-        cursor.execute('GRANT ALL PRIVILEGES ON {0}.* TO {1}@"%"'.format(db_name, rds_username))
-    except Exception as e:
-        logger.error(e, exc_info=True)
-        db.rollback()
+        logger.info('Creating {0} in {1}...'.format(customer, rds_hostname))
+        cursor.execute(
+            'CREATE DATABASE `{0}`; '
+            'GRANT ALL PRIVILEGES ON `{0}`.* TO {1}@"%"'
+            .format(db_name, conn.escape(rds_username))
+        )
+
+        # Read the GRANT result, this also raises any error it returned
+        while cursor.nextset():
+            pass
+    except pymysql.MySQLError as e:
+        logger.error(e)
+        conn.rollback()
 
-    db.close()
+    cursor.close()
 
 
 def create_dns_record(customer_url):
     """
     Create a new DNS record in Route 53
     """
+    r53 = get_client('route53')
+
     try:
         r_type = 'CNAME'
-        action = 'CREATE'
+        action = 'UPSERT'
         ttl = 300
 
         logger.info('Creating {}'.format(customer_url))
 
-        r53.change_resource_record_sets(
+        response = r53.change_resource_record_sets(
             HostedZoneId=hosted_zone_id,
             ChangeBatch={
                 'Changes': [
@@ -286,11 +725,21 @@ def create_dns_record(customer_url):
             }
         )
 
+        # Wait until the change has reached all Route 53 name servers
+        waiter = r53.get_waiter('resource_record_sets_changed')
+        waiter.wait(
+            Id=response['ChangeInfo']['Id'],
+            WaiterConfig={
+                'Delay': 10,
+                'MaxAttempts': 30
+            }
+        )
+
         logger.info('Created {}'.format(customer_url))
         return customer_url
-    except Exception as e:
-        logger.error(e, exc_info=True)
-        sys.exit(1)
+    except (ClientError, WaiterError) as e:
+        logger.error(e)
+        raise
 
 
 # noinspection PyUnusedLocal
@@ -301,14 +750,26 @@ def main(event, context):
     try:
         customer = event['params']['path']['customer']
         customer_url = '{0}.{1}'.format(customer, domain)
-        key = check_version()
-        extraction_path = download_from_s3(key)
 
-        create_vhost(customer, extraction_path)
-        create_db(customer)
+        # The database and DNS record don't depend on the app bundle
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            db_future = executor.submit(create_db, customer)
+
+            key = check_version()
+            new_app_version = get_version_label()
+
+            # Append the vhost to a copy of the bundle inside S3 if we can,
+            # otherwise download, extract and re-zip the whole app
+            if not append_vhost(customer, key, new_app_version):
+                extraction_path = download_from_s3(key)
+                create_vhost(customer, extraction_path)
+                upload_app(extraction_path, new_app_version)
+
+            db_future.result()
 
-        new_app_version = deploy_app(extraction_path)
-        create_dns_record(customer_url)
+            dns_future = executor.submit(create_dns_record, customer_url)
+            deploy_app(new_app_version)
+            dns_future.result()
 
         output = {
             'CustomerName': customer,